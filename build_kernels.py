@@ -0,0 +1,24 @@
+"""
+Ahead-of-time compiles the runoff reduction kernels of functionality.py into the extension module
+_perisponge_kernels, which functionality.py prefers over compiling them with numba at runtime.
+
+Only the scalar propagate kernel avoids the import-time compilation this way. pycc ignores parallel=True, so
+functionality.py uses the exported propagate_batch only when numba is not installed at runtime; with numba the
+parallel batch kernel is still JIT compiled when functionality.py is imported.
+
+Usage:
+    python build_kernels.py
+"""
+from pathlib import Path
+from numba.pycc import CC
+
+from functionality import (_propagate_kernel, _propagate_batch_kernel,
+                           PROPAGATE_SIGNATURE, PROPAGATE_BATCH_SIGNATURE)
+
+cc = CC("_perisponge_kernels")
+cc.output_dir = str(Path(__file__).parent)
+cc.export("propagate", PROPAGATE_SIGNATURE)(_propagate_kernel)
+cc.export("propagate_batch", PROPAGATE_BATCH_SIGNATURE)(_propagate_batch_kernel)
+
+if __name__ == "__main__":
+    cc.compile()
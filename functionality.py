@@ -1,40 +1,276 @@
+import sys
 from pathlib import Path
+from collections import namedtuple
 import numpy as np
 import networkx as nx
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
+try:
+    import numba
+    from numba import prange
+except ImportError:  # numba is optional, the reduction falls back to numpy
+    numba = None
+    prange = range
 
-def calc_flow_dfs(g, precip, retention=None, psi=None):
+NetworkPlan = namedtuple("NetworkPlan", ["nodes", "order", "indptr", "indices", "area_ha", "area_ha32", "area_subtree"])
+
+
+def _propagate_numpy(order, indptr, indices, vq, retention):
     """
-    Calculates runoff from each subcatchment in the graph, taking into consideration precipitation, runon and retention volume.
+    Adds the runoff of the children to each parent in the given order, modifies vq in place.
+    Args:
+        order (np.array): Node indices, children before parents
+        indptr (np.array): CSR index pointer of children per node
+        indices (np.array): CSR children per node
+        vq (np.array): Runoff of each node from its own precipitation in m³
+        retention (np.array): Retention volume left after own precipitation in m³
+
+    Returns:
+        None
+    """
+    for p in order:
+        vq[p] += max(vq[indices[indptr[p]:indptr[p + 1]]].sum() - retention[p], 0)
+
+
+def _propagate_batch_numpy(order, indptr, indices, vq, retention):
+    """
+    Adds the runoff of the children to each parent in the given order for several storms at once, modifies vq in place.
+    Args:
+        order (np.array): Node indices, children before parents
+        indptr (np.array): CSR index pointer of children per node
+        indices (np.array): CSR children per node
+        vq (np.array): Runoff of each storm (rows) and node (columns) from its own precipitation in m³
+        retention (np.array): Retention volume left after own precipitation, same shape as vq
+
+    Returns:
+        None
+    """
+    for p in order:
+        vq[:, p] += np.maximum(vq[:, indices[indptr[p]:indptr[p + 1]]].sum(axis=1) - retention[:, p], 0)
+
+
+def _propagate_kernel(order, indptr, indices, vq, retention):
+    """
+    Scalar version of _propagate_numpy, compiled with numba, see build_kernels.py.
+    """
+    for p in order:
+        s = 0.0
+        for k in range(indptr[p], indptr[p + 1]):
+            s += vq[indices[k]]
+        d = s - retention[p]
+        if d > 0.0:
+            vq[p] += d
+
+
+def _propagate_batch_kernel(order, indptr, indices, vq, retention):
+    """
+    Batched version of _propagate_kernel for storms (rows) x nodes (columns), compiled with numba. Storms are
+    independent and distributed over threads with prange, each thread works on its own contiguous row of vq.
+    """
+    for s in prange(vq.shape[0]):
+        for p in order:
+            acc = np.float32(0.0)
+            for k in range(indptr[p], indptr[p + 1]):
+                acc += vq[s, indices[k]]
+            d = acc - retention[s, p]
+            if d > 0:
+                vq[s, p] += d
+
+
+PROPAGATE_SIGNATURE = "void(int32[::1], int32[::1], int32[::1], float64[:], float64[:])"
+PROPAGATE_BATCH_SIGNATURE = "void(int32[::1], int32[::1], int32[::1], float32[:, ::1], float32[:, ::1])"
+
+try:  # ahead-of-time compiled kernels, built with build_kernels.py
+    from _perisponge_kernels import propagate as _propagate
+except ImportError:
+    if numba is not None:
+        # the kernels touch no python objects, releasing the GIL lets other threads run meanwhile
+        _propagate = numba.njit(PROPAGATE_SIGNATURE, cache=True, fastmath=True, nogil=True)(_propagate_kernel)
+    else:
+        _propagate = _propagate_numpy
+
+if numba is not None:
+    # pycc ignores parallel=True, the ahead-of-time batch kernel would run serially; the batch kernel is therefore
+    # always compiled at import when numba is installed, even if _perisponge_kernels exists
+    _propagate_batch = numba.njit(PROPAGATE_BATCH_SIGNATURE, parallel=True, cache=True, fastmath=True,
+                                  nogil=True)(_propagate_batch_kernel)
+else:
+    try:
+        from _perisponge_kernels import propagate_batch as _propagate_batch
+    except ImportError:
+        _propagate_batch = _propagate_batch_numpy
+
+
+def index_graph(g):
+    """
+    Freezes the node order of the graph in g.graph["node_order"] and caches the node index and the node areas on the
+    graph. All per node arrays (retention, runoff) are aligned with g.graph["node_order"]. The cache is private and
+    not written with the graph; it is rebuilt automatically when the nodes or edges change, but not when areas
+    change, so run again after changing areas. The functions of this module index the graph if necessary.
+    Args:
+        g (nx.DiGraph): Graph of drainage network
+
+    Returns:
+        None
+    """
+    # interned names let lookups with the same (e.g. literal) name short-circuit on identity
+    order = [sys.intern(n) if isinstance(n, str) else n for n in g.nodes]
+    g.graph["node_order"] = order
+    g._index_cache = {
+        "node_order": list(order),
+        "edges": set(g.edges),
+        "node_index": {n: i for i, n in enumerate(order)},
+        "area_ha": np.fromiter((g.nodes[n]["area_ha"] for n in order), dtype=np.float64, count=len(order)),
+    }
+
+
+def _get_index_cache(g):
+    """
+    Returns the cache of index_graph, reindexing the graph if its nodes or edges changed since.
     Args:
         g (nx.DiGraph): Graph of drainage network
+
+    Returns:
+        dict: cached node order, edges, node index, node areas and, once computed, the NetworkPlan
+    """
+    cache = getattr(g, "_index_cache", None)
+    if (cache is None or cache["node_order"] != list(g.nodes) or cache["edges"] != set(g.edges)
+            or g.graph.get("node_order") != cache["node_order"]):
+        index_graph(g)
+        cache = g._index_cache
+    return cache
+
+
+def _get_node_index(g):
+    """
+    Returns the mapping of node name to position in g.graph["node_order"], indexing the graph if necessary.
+    Args:
+        g (nx.DiGraph): Graph of drainage network
+
+    Returns:
+        dict: dictionary with node as key and index as value
+    """
+    return _get_index_cache(g)["node_index"]
+
+
+def _get_area_ha(g):
+    """
+    Returns the area in ha of each node in g.graph["node_order"], indexing the graph if necessary.
+    Args:
+        g (nx.DiGraph or nx.Graph): graph with subcatchments and assigned area in ha
+
+    Returns:
+        np.array: array with area of each subcatchment in ha
+    """
+    return _get_index_cache(g)["area_ha"]
+
+
+def precompute_network(g, root="alois-hamtod-weg"):
+    """
+    Precomputes everything of the drainage network that does not depend on precipitation or retention.
+    Args:
+        g (nx.DiGraph): Graph of drainage network
+        root (str): Name of the outlet subcatchment
+
+    Returns:
+        NetworkPlan: node names, processing order (children before parents), children of each node as CSR
+        (indptr, indices), area of each node in ha as float64 and as float32 for the batched solve and area in ha
+        drained by each node including all upstream nodes (float32), all aligned with g.graph["node_order"]
+    """
+    # dfs search for root
+    successors = nx.dfs_successors(g.reverse(copy=False), root)
+    cache = _get_index_cache(g)
+    idx = cache["node_index"]
+    nodes = cache["node_order"]
+    order = np.array([idx[n] for n in reversed(successors)], dtype=np.int32)
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(successors.get(n, ())) for n in nodes])
+    indices = np.array([idx[c] for n in nodes for c in successors.get(n, ())], dtype=np.int32)
+    area_ha = _get_area_ha(g)
+    # hydrological volumes do not need double precision, float32 halves the memory traffic of the batched solve
+    area_ha32 = area_ha.astype(np.float32)
+    # without retention, runoff of a node is simply its drained area times the precipitation
+    area_subtree = area_ha.copy()
+    _propagate(order, indptr, indices, area_subtree, np.zeros(len(nodes)))
+    return NetworkPlan(nodes, order, indptr, indices, area_ha, area_ha32, area_subtree.astype(np.float32))
+
+
+def _get_network_plan(g):
+    """
+    Returns the NetworkPlan of the graph, precomputed on first use and cached alongside the node index.
+    Args:
+        g (nx.DiGraph): Graph of drainage network
+
+    Returns:
+        NetworkPlan: see precompute_network
+    """
+    # reindexing the graph replaces the whole cache and with it the plan
+    cache = _get_index_cache(g)
+    if "network_plan" not in cache:
+        cache["network_plan"] = precompute_network(g)
+    return cache["network_plan"]
+
+
+def calc_flow_fast(plan, precip, retention=None):
+    """
+    Calculates runoff from each subcatchment of a precomputed network for a single precipitation.
+    Args:
+        plan (NetworkPlan): Precomputed network, see precompute_network
         precip (float): Precipitation in mm
-        retention (np.array): Retention volumes for [n for n in g.nodes]
-        psi (float): Discharge coefficient, not implemented
+        retention (np.array): Retention volumes for g.graph["node_order"]
 
     Returns:
         np.array: array with runoff from each catchment
     """
-    # dfs search for root
-    order = nx.dfs_successors(g.reverse(), "alois-hamtod-weg")
-    # initialisieren der konstanten werte
-    nodes = np.array([n for n in g.nodes])
     if retention is None:
-        retention = np.zeros(len(nodes))
-
-    precip = calc_VQR(g, precip)
-    precip = np.array([precip[n] for n in nodes])
+        retention = np.zeros(len(plan.nodes))
+    precip = plan.area_ha * precip * 10
+    retention = np.asarray(retention, dtype=np.float64)
     vq = np.maximum(precip - retention, 0)
     retention = np.maximum(retention - precip, 0)
-    for element in reversed(order):
-        i = np.where(nodes==element)[0]
-        mask = np.isin(nodes, order[element])
-        vq[i] += max(vq[mask].sum() - retention[i], 0)
+    _propagate(plan.order, plan.indptr, plan.indices, vq, retention)
     return vq
 
 
+def calc_flow_batch(plan, precip, retention=None):
+    """
+    Calculates runoff from each subcatchment of a precomputed network for several precipitations at once.
+    Args:
+        plan (NetworkPlan): Precomputed network, see precompute_network
+        precip (np.array): Precipitations in mm
+        retention (np.array): Retention volumes for g.graph["node_order"]
+
+    Returns:
+        np.array: float32 array with runoff from each catchment (rows) for each precipitation (columns)
+    """
+    precip = np.asarray(precip, dtype=np.float32).ravel()
+    if retention is None or not np.any(retention):
+        return np.outer(plan.area_subtree, precip) * np.float32(10)
+    # storms x nodes, so that the independent storms are contiguous rows
+    precip = np.outer(precip, plan.area_ha32) * np.float32(10)
+    retention = np.asarray(retention, dtype=np.float32)[None, :]
+    vq = np.maximum(precip - retention, 0)
+    retention = np.maximum(retention - precip, 0)
+    _propagate_batch(plan.order, plan.indptr, plan.indices, vq, retention)
+    return vq.T
+
+
+def calc_flow_dfs(g, precip, retention=None, psi=None):
+    """
+    Calculates runoff from each subcatchment in the graph, taking into consideration precipitation, runon and retention volume.
+    Args:
+        g (nx.DiGraph): Graph of drainage network
+        precip (float): Precipitation in mm
+        retention (np.array): Retention volumes for g.graph["node_order"]
+        psi (float): Discharge coefficient, not implemented
+
+    Returns:
+        np.array: array with runoff from each catchment
+    """
+    return calc_flow_fast(_get_network_plan(g), precip, retention=retention)
+
+
 def calc_VQR(g, precip):
     """
     Returns VQR in m³, takes precip in mm and area in ha
@@ -45,9 +281,8 @@ def calc_VQR(g, precip):
     Returns:
         dict: dictionary with node as key and VQR as value
     """
-    def vr(node):
-        return g.nodes[node]["area_ha"] * precip * 10
-    return {n: vr(n) for n in g.nodes}
+    cache = _get_index_cache(g)
+    return dict(zip(cache["node_order"], (cache["area_ha"] * precip * 10).tolist()))
 
 
 def set_retention(node, volume, graph, retention=None):
@@ -60,41 +295,41 @@ def set_retention(node, volume, graph, retention=None):
         retention (np.array): Existing retention array
 
     Returns:
-        np.array: Array with retention volume for each node in [n for n in g.nodes]
+        np.array: Array with retention volume for each node in g.graph["node_order"]
+
+    Raises:
+        KeyError: If node is not a subcatchment of graph
     """
+    idx = _get_node_index(graph)
     if retention is None:
-        retention = np.zeros(len(graph.nodes))
-    retention[np.where(np.array(graph.nodes) == node)] = volume
+        retention = np.zeros(len(idx))
+    retention[idx[node]] = volume
     return retention
 
 
-def plot_vq(g, subcat, df_storms, retention=None, odir=None, save=False):
+def _draw_vq(fig, ax1, durations, storms_of_interest, vqs, colorbar=True):
     """
-    plots runoff from specified subcatchment for various design storms
+    Draws runoff volumes for various design storms onto an axis
     Args:
-        g (nx.DiGraph): Graph of hydrological model
-        subcat (str): Name of subcatchment for which to plot runoff
-        df_storms (pd.DataFrame): Dataframe containing the precipitation volumes for return periods and durations
-        retention (np.array): Numpy-Array containing retention volumes for each subcatchment
-        odir (Path): Path for plot to write to, not implemented
+        fig (plt.Figure): Figure containing ax1
+        ax1 (plt.Axes): Axis to draw on
+        durations (np.array): Durations of the design storms in min
+        storms_of_interest (np.array): Return periods of the design storms in a
+        vqs (np.array): Runoff volumes in m³ for each duration (rows) and return period (columns)
+        colorbar (bool): Whether to add a colorbar for the return periods
 
     Returns:
-        None
+        list: Line2D for each return period
     """
-    nodes = np.array(g.nodes)
-    index_of_interest = np.where(nodes == subcat)[0][0]
-    storms_of_interest = df_storms.columns.values
-    durations = df_storms.index.values
-
-    fig, ax1 = plt.subplots(constrained_layout=True, figsize=[8.5, 6])
+    norm = mpl.colors.LogNorm(vmin=1, vmax=100)
+    cmap = mpl.colormaps["cool"]
+    colors = cmap(norm(storms_of_interest.astype(float)))
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
 
-    fig.suptitle(f"Abflussvolumina nach Jährlichkeit und Dauerstufe von: {subcat}")
-
-    sm = plt.cm.ScalarMappable(cmap=mpl.colormaps["cool"], norm=mpl.colors.LogNorm(vmin=1, vmax=100))
-
-    for return_period in storms_of_interest:
-        vq = list(map(lambda p: calc_flow_dfs(g, p, retention=retention)[index_of_interest], df_storms[return_period].values))
-        ax1.plot(durations, vq, color=mpl.colormaps["cool"](mpl.colors.LogNorm(vmin=1, vmax=100)(return_period)))
+    lines = []
+    for i in range(len(storms_of_interest)):
+        vq = vqs[:, i]
+        lines += ax1.plot(durations, vq, color=colors[i])
 
     ax1.set(ylabel="Abflussvolumen [m³]",
             xlabel="Dauer des Regenereignisses [h]", xlim=[0, 1440], xticks=np.arange(0, 1620, 180))
@@ -102,17 +337,124 @@ def plot_vq(g, subcat, df_storms, retention=None, odir=None, save=False):
     ax1.xaxis.set_major_formatter(lambda x, pos: f"{x/60:.0f}")
     formatter = mpl.ticker.LogFormatter(10, labelOnlyBase=False, minor_thresholds=(np.inf, np.inf))
 
-    fig.colorbar(sm, ax=ax1, ticks=[1, 3, 5, 10, 30, 100], format=formatter, label="Jährlichkeit")
+    if colorbar:
+        fig.colorbar(sm, ax=ax1, ticks=[1, 3, 5, 10, 30, 100], format=formatter, label="Jährlichkeit")
     custom_lines = [mpl.lines.Line2D([0], [0], color="black", lw=1),
                     mpl.lines.Line2D([0], [0], color="black", lw=1, linestyle="dotted")]
     # fig.legend(custom_lines, ["Oberflächenabfluss Gesamt", "Oberflächenabfluss Intensität"],
     #            loc="upper left", bbox_to_anchor=(0.1,0.9))
     ax1.grid(zorder=0)
+    return lines
+
+
+def plot_vq(g, subcat, df_storms, retention=None, odir=None, save=False, ax=None, colorbar=True):
+    """
+    plots runoff from specified subcatchment for various design storms
+    Args:
+        g (nx.DiGraph): Graph of hydrological model
+        subcat (str): Name of subcatchment for which to plot runoff
+        df_storms (pd.DataFrame): Dataframe containing the precipitation volumes for return periods and durations
+        retention (np.array): Numpy-Array containing retention volumes for each subcatchment
+        odir (Path): Path for plot to write to, not implemented
+        ax (plt.Axes): Existing axis to plot on, a new figure is created if None
+        colorbar (bool): Whether to add a colorbar for the return periods
+
+    Returns:
+        None
+    """
+    index_of_interest = _get_node_index(g)[subcat]
+    plan = _get_network_plan(g)
+    storms_of_interest = df_storms.columns.values
+    durations = df_storms.index.values
+
+    if ax is None:
+        fig, ax1 = plt.subplots(constrained_layout=True, figsize=[8.5, 6])
+        fig.suptitle(f"Abflussvolumina nach Jährlichkeit und Dauerstufe von: {subcat}")
+    else:
+        fig, ax1 = ax.figure, ax
+        ax1.set_title(subcat)
+
+    precips = df_storms.to_numpy()
+    vqs = calc_flow_batch(plan, precips, retention=retention)[index_of_interest].reshape(precips.shape)
+    _draw_vq(fig, ax1, durations, storms_of_interest, vqs, colorbar=colorbar)
     if save:
         fig.savefig(odir/f"oberflaechenabfluss_{subcat}.png", dpi=600, transparent=True)
     return
 
 
+def _capture_background(fig, artists):
+    """
+    Renders the figure without the given artists and returns the rendered image for blitting
+    Args:
+        fig (plt.Figure): Figure to render
+        artists (list): Artists that are redrawn on top of the background
+
+    Returns:
+        object: Backend specific copy of the rendered figure
+    """
+    for artist in artists:
+        artist.set_animated(True)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    for artist in artists:
+        artist.set_animated(False)
+    return background
+
+
+def plot_vq_many(g, subcats, df_storms, retention=None, odir=None, save=False):
+    """
+    plots runoff from several subcatchments for various design storms, reusing a single figure with a shared y-axis
+    Args:
+        g (nx.DiGraph): Graph of hydrological model
+        subcats (list): Names of subcatchments for which to plot runoff
+        df_storms (pd.DataFrame): Dataframe containing the precipitation volumes for return periods and durations
+        retention (np.array): Numpy-Array containing retention volumes for each subcatchment
+        odir (Path): Path for plots to write to
+
+    Returns:
+        None
+    """
+    subcats = list(subcats)
+    idx = _get_node_index(g)
+    plan = _get_network_plan(g)
+    storms_of_interest = df_storms.columns.values
+    durations = df_storms.index.values
+
+    # runoff of every subcatchment for every storm in one solve
+    precips = df_storms.to_numpy()
+    vqs = calc_flow_batch(plan, precips, retention=retention).reshape((-1,) + precips.shape)
+
+    fig, ax1 = plt.subplots(constrained_layout=True, figsize=[8.5, 6])
+
+    lines = None
+    background = None
+    for subcat in subcats:
+        title = fig.suptitle(f"Abflussvolumina nach Jährlichkeit und Dauerstufe von: {subcat}")
+        if lines is None:
+            lines = _draw_vq(fig, ax1, durations, storms_of_interest, vqs[idx[subcat]])
+            # shared y-axis, so that only title and lines change between subcatchments
+            ax1.set_ylim(0, vqs[[idx[s] for s in subcats]].max() * 1.05 or 1)
+        else:
+            for i, line in enumerate(lines):
+                line.set_ydata(vqs[idx[subcat], :, i])
+        # when saving, savefig renders the whole figure anyway
+        if not save:
+            if not fig.canvas.supports_blit:
+                fig.canvas.draw_idle()
+            else:
+                if background is None:
+                    background = _capture_background(fig, [title] + lines)
+                fig.canvas.restore_region(background)
+                for artist in [title] + lines:
+                    fig.draw_artist(artist)
+                fig.canvas.blit(fig.bbox)
+            # show each subcatchment, not only the last one
+            fig.canvas.flush_events()
+        if save:
+            fig.savefig(odir/f"oberflaechenabfluss_{subcat}.png", dpi=600, transparent=True)
+    return
+
+
 def plot_total_runoff(df_storms, df_subcats, odir=None, save=False):
     storms_of_interest = df_storms.columns.values
     durations = df_storms.index.values
@@ -123,14 +465,19 @@ def plot_total_runoff(df_storms, df_subcats, odir=None, save=False):
 
     fig.suptitle("Anfallende Niederschlagsvolumina nach Jährlichkeit und Dauerstufe")
 
-    sm = plt.cm.ScalarMappable(cmap=mpl.colormaps["cool"], norm=mpl.colors.LogNorm(vmin=1, vmax=100))
+    norm = mpl.colors.LogNorm(vmin=1, vmax=100)
+    cmap = mpl.colormaps["cool"]
+    colors = cmap(norm(storms_of_interest.astype(float)))
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
 
-    for i, return_period in enumerate(storms_of_interest):
-        vr = (df_storms[return_period] * area * 10).values
-        ax2.plot(durations, vr, color=mpl.colormaps["cool"](mpl.colors.LogNorm(vmin=1, vmax=100)(return_period)))
-        q = vr / durations * 1000 / 60
-        ax1.plot(durations, q, color=mpl.colormaps["cool"](mpl.colors.LogNorm(vmin=1, vmax=100)(return_period)),
-                 linestyle="dotted")
+    vrs = df_storms.to_numpy() * area * 10
+    for i in range(len(storms_of_interest)):
+        vr = vrs[:, i]
+        ax2.plot(durations, vr, color=colors[i])
+        q = np.empty_like(vr)
+        np.divide(vr, durations, out=q)
+        q *= 1000 / 60
+        ax1.plot(durations, q, color=colors[i], linestyle="dotted")
 
     ax2.set(ylabel="Niederschlagsmenge [m³]", ylim=[0, 12000],
             xlabel="Dauer [h]", xlim=[0, 1440], xticks=np.arange(0, 1620,